@@ -4,34 +4,49 @@
 # See LICENSE for more information
 
 import argparse
+import bisect
 import fnmatch
+import functools
 import itertools
 import json
 import os
-from operator import itemgetter
-import pprint
 import pathlib
 import requests
 import subprocess
+import tempfile
 import textwrap
 import unidiff
 import yaml
+import concurrent.futures
 import contextlib
 import datetime
 import re
 import io
 import zipfile
 from github import Github, Auth
-from github.Requester import Requester
-from github.PaginatedList import PaginatedList
 from github.WorkflowRun import WorkflowRun
 from typing import List, Optional, TypedDict
 
-DIFF_HEADER_LINE_LENGTH = 5
+try:
+    # The C loader is much faster on the MB-scale fixes files clang-tidy
+    # can produce, but libyaml isn't always available
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+try:
+    # Much faster than stdlib json on the multi-MB compile databases
+    # large projects generate, but only an optional speedup
+    import orjson
+except ImportError:
+    orjson = None
+
 FIXES_FILE = "clang_tidy_review.yaml"
 METADATA_FILE = "clang-tidy-review-metadata.json"
 REVIEW_FILE = "clang-tidy-review-output.json"
+DIFF_CACHE_FILE = pathlib.Path.home() / ".cache/clang-tidy-review/diff-cache.json"
 MAX_ANNOTATIONS = 10
+CLANG_TIDY_VERSION_RE = re.compile(r"version (\d+)")
 
 
 class Metadata(TypedDict):
@@ -117,42 +132,84 @@ def build_clang_tidy_warnings(
 
     config = config_file_or_checks(clang_tidy_binary, clang_tidy_checks, config_file)
 
-    args = [
+    base_args = [
         clang_tidy_binary,
         f"-p={build_dir}",
         f"-line-filter={line_filter}",
-        f"--export-fixes={FIXES_FILE}",
     ]
 
     if config:
         print(f"Using config: {config}")
-        args.append(config)
+        base_args.append(config)
     else:
         print("Using recursive directory config")
 
-    args += files
+    env = dict(os.environ)
+    env["USER"] = username
 
-    start = datetime.datetime.now()
-    try:
-        with message_group(f"Running:\n\t{args}"):
-            env = dict(os.environ)
-            env["USER"] = username
+    def run_one_file(file: str, fixes_path: str) -> None:
+        # clang-tidy only applies line-filter entries matching the file
+        # it's checking, so each worker can take the whole filter
+        try:
             subprocess.run(
-                args,
+                base_args + [f"--export-fixes={fixes_path}", file],
                 capture_output=True,
                 check=True,
                 encoding="utf-8",
                 env=env,
             )
-    except subprocess.CalledProcessError as e:
-        print(
-            f"\n\nclang-tidy failed with return code {e.returncode} and error:\n{e.stderr}\nOutput was:\n{e.stdout}"
-        )
+        except subprocess.CalledProcessError as e:
+            print(
+                f"\n\nclang-tidy failed with return code {e.returncode} and error:\n{e.stderr}\nOutput was:\n{e.stdout}"
+            )
+
+    start = datetime.datetime.now()
+    # clang-tidy is CPU-bound per translation unit, so check the files
+    # in parallel, one process each, and merge the fixes afterwards
+    with message_group(
+        f"Running clang-tidy on {len(files)} files:\n\t{base_args}"
+    ), tempfile.TemporaryDirectory() as fixes_dir:
+        fixes_paths = [
+            os.path.join(fixes_dir, f"{num}.yaml") for num in range(len(files))
+        ]
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=os.cpu_count()
+        ) as executor:
+            for _ in executor.map(run_one_file, files, fixes_paths):
+                pass
+
+        merge_fixes_files(fixes_paths)
     end = datetime.datetime.now()
 
     print(f"Took: {end - start}")
 
 
+def merge_fixes_files(fixes_paths: List[str]) -> None:
+    """Merge per-file clang-tidy fixes files into a single FIXES_FILE"""
+
+    main_source_file = ""
+    diagnostics = []
+    for fixes_path in fixes_paths:
+        try:
+            with open(fixes_path, "r") as fixes_file:
+                fixes = yaml.load(fixes_file, Loader=YamlLoader)
+        except FileNotFoundError:
+            # clang-tidy doesn't write a fixes file if there was
+            # nothing to report for this file
+            continue
+        if not fixes:
+            continue
+        main_source_file = fixes.get("MainSourceFile", main_source_file)
+        diagnostics.extend(fixes.get("Diagnostics", []))
+
+    if diagnostics:
+        with open(FIXES_FILE, "w") as fixes_file:
+            yaml.safe_dump(
+                {"MainSourceFile": main_source_file, "Diagnostics": diagnostics},
+                fixes_file,
+            )
+
+
 def clang_tidy_version(clang_tidy_binary: pathlib.Path):
     try:
         version_out = subprocess.run(
@@ -165,7 +222,7 @@ def clang_tidy_version(clang_tidy_binary: pathlib.Path):
         print(f"\n\nWARNING: Couldn't get clang-tidy version, error was: {e}")
         return 0
 
-    if version := re.search(r"version (\d+)", version_out):
+    if version := CLANG_TIDY_VERSION_RE.search(version_out):
         return int(version.group(1))
 
     print(
@@ -200,11 +257,32 @@ def load_clang_tidy_warnings():
     """Read clang-tidy warnings from FIXES_FILE. Can be produced by build_clang_tidy_warnings"""
     try:
         with open(FIXES_FILE, "r") as fixes_file:
-            return yaml.safe_load(fixes_file)
+            return yaml.load(fixes_file, Loader=YamlLoader)
     except FileNotFoundError:
         return {}
 
 
+def load_diff_cache() -> dict:
+    """Read the on-disk cache of PR diffs used for conditional requests"""
+    try:
+        with open(DIFF_CACHE_FILE, "r") as cache_file:
+            return json.load(cache_file)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def save_diff_cache(key: str, etag: str, body: str) -> None:
+    """Store the ETag and body of a downloaded diff, keyed by repo and PR"""
+    cache = load_diff_cache()
+    cache[key] = {"etag": etag, "body": body}
+    try:
+        DIFF_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        with open(DIFF_CACHE_FILE, "w") as cache_file:
+            json.dump(cache, cache_file)
+    except OSError as e:
+        print(f"WARNING: Couldn't save diff cache ('{DIFF_CACHE_FILE}'): {e}")
+
+
 class PullRequest:
     """Add some convenience functions not in PyGithub"""
 
@@ -216,6 +294,10 @@ class PullRequest:
         # Choose API URL, default to public GitHub
         self.api_url = os.environ.get("GITHUB_API_URL", "https://api.github.com")
 
+        # One session with keep-alive for all our direct API calls, so
+        # we don't pay for a new TLS handshake on every request
+        self.session = requests.Session()
+
         github = Github(auth=self.auth, base_url=self.api_url)
         self.repo = github.get_repo(f"{repo}")
         self._pull_request = None
@@ -245,42 +327,162 @@ class PullRequest:
 
     def get(self, media_type: str, extra: str = "") -> str:
         url = f"{self.base_url}{extra}"
-        response = requests.get(url, headers=self.headers(media_type))
+        response = self.session.get(url, headers=self.headers(media_type))
         response.raise_for_status()
         return response.text
 
-    def get_pr_diff(self) -> List[unidiff.PatchSet]:
+    def get_pr_diff(self) -> List[unidiff.PatchedFile]:
         """Download the PR diff, return a list of PatchedFile"""
 
-        diffs = self.get("v3.diff")
-
-        # PatchSet is the easiest way to construct what we want, but the
-        # diff_line_no property on lines is counted from the top of the
-        # whole PatchSet, whereas GitHub is expecting the "position"
-        # property to be line count within each file's diff. So we need to
-        # do this little bit of faff to get a list of file-diffs with
-        # their own diff_line_no range
-        diff = [unidiff.PatchSet(str(file))[0] for file in unidiff.PatchSet(diffs)]
-        return diff
+        headers = self.headers("v3.diff")
+
+        # Re-runs for the same PR usually see an identical diff, so ask
+        # GitHub to skip the body if our cached copy is still current
+        cache_key = f"{self.repo_name}#{self.pr_number}"
+        cached = load_diff_cache().get(cache_key, {})
+        if "etag" in cached:
+            headers["If-None-Match"] = cached["etag"]
+
+        # The diff_line_no property on lines is counted from the top of
+        # the whole PatchSet, whereas GitHub is expecting the "position"
+        # property to be the line count within each file's diff.
+        # make_file_line_lookup converts between the two, so one parse
+        # of the whole diff is enough
+        with self.session.get(self.base_url, headers=headers, stream=True) as response:
+            if (
+                response.status_code == requests.codes.not_modified
+                and "body" in cached
+            ):
+                print("PR diff unchanged since last run, using cached copy")
+                return list(unidiff.PatchSet(cached["body"]))
+
+            response.raise_for_status()
+            if response.encoding is None:
+                response.encoding = "utf-8"
+
+            # Feed the diff into the parser as it downloads instead of
+            # buffering the whole body first, keeping the lines so the
+            # body can be cached alongside its ETag
+            lines = []
+
+            def stream_lines():
+                # Split on "\n" explicitly: the default split uses
+                # str.splitlines, which also breaks on form feeds and
+                # Unicode line separators inside diff content lines.
+                # The delimiter is stripped, so look ahead one line to
+                # restore it everywhere except a missing final newline,
+                # and to drop the empty leftover after a trailing one
+                iterator = response.iter_lines(decode_unicode=True, delimiter="\n")
+                previous = next(iterator, None)
+                for current in iterator:
+                    line = previous + "\n"
+                    lines.append(line)
+                    yield line
+                    previous = current
+                if previous:
+                    lines.append(previous)
+                    yield previous
+
+            diff = list(unidiff.PatchSet(stream_lines()))
+
+            if etag := response.headers.get("ETag"):
+                save_diff_cache(cache_key, etag, "".join(lines))
+
+            return diff
 
     def get_pr_author(self) -> str:
         """Get the username of the PR author. This is used in google-readability-todo"""
         return self.pull_request.user.login
 
     def get_pr_comments(self):
-        """Download the PR review comments using the comfort-fade preview headers"""
+        """Download the PR review comments, fetching all pages concurrently"""
 
-        def get_element(
-            requester: Requester, headers: dict, element: dict, completed: bool
-        ):
-            return element
+        url = f"{self.base_url}/comments"
+        headers = self.headers("v3+json")
 
-        return PaginatedList(
-            get_element,
-            self.pull_request._requester,
-            f"{self.base_url}/comments",
-            None,
+        def get_page(page: int) -> List[dict]:
+            response = self.session.get(
+                url, headers=headers, params={"per_page": 100, "page": page}
+            )
+            response.raise_for_status()
+            return response.json()
+
+        first_response = self.session.get(
+            url, headers=headers, params={"per_page": 100}
         )
+        first_response.raise_for_status()
+        comments = first_response.json()
+
+        # The Link header tells us how many pages there are in total, so
+        # we can fetch the remaining pages in parallel instead of
+        # walking them one round-trip at a time
+        last_page = 1
+        if match := re.search(
+            r'[?&]page=(\d+)[^>]*>; rel="last"', first_response.headers.get("Link", "")
+        ):
+            last_page = int(match.group(1))
+
+        if last_page > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
+                for page in executor.map(get_page, range(2, last_page + 1)):
+                    comments.extend(page)
+
+        return comments
+
+    def get_review_comment_fingerprints(self) -> set:
+        """Fetch (path, line, body) fingerprints of the existing review
+        comments with the GraphQL API, which returns up to 100 threads
+        per round-trip and only the fields we need
+
+        """
+        query = textwrap.dedent(
+            """\
+            query reviewComments($owner: String!, $name: String!, $number: Int!, $cursor: String) {
+              repository(owner: $owner, name: $name) {
+                pullRequest(number: $number) {
+                  reviewThreads(first: 100, after: $cursor) {
+                    pageInfo { hasNextPage endCursor }
+                    nodes {
+                      path
+                      line
+                      comments(first: 100) { nodes { body } }
+                    }
+                  }
+                }
+              }
+            }
+            """
+        )
+        graphql_url = os.environ.get("GITHUB_GRAPHQL_URL", f"{self.api_url}/graphql")
+        headers = {"Authorization": f"Bearer {self.token}"}
+        owner, _, name = self.repo_name.partition("/")
+        variables = {
+            "owner": owner,
+            "name": name,
+            "number": int(self.pr_number),
+            "cursor": None,
+        }
+
+        fingerprints = set()
+        while True:
+            response = self.session.post(
+                graphql_url,
+                json={"query": query, "variables": variables},
+                headers=headers,
+            )
+            response.raise_for_status()
+            payload = response.json()
+            if payload.get("errors"):
+                raise RuntimeError(f"GraphQL query failed: {payload['errors']}")
+
+            threads = payload["data"]["repository"]["pullRequest"]["reviewThreads"]
+            for thread in threads["nodes"]:
+                for comment in thread["comments"]["nodes"]:
+                    fingerprints.add((thread["path"], thread["line"], comment["body"]))
+
+            if not threads["pageInfo"]["hasNextPage"]:
+                return fingerprints
+            variables["cursor"] = threads["pageInfo"]["endCursor"]
 
     def post_lgtm_comment(self, body: str):
         """Post a "LGTM" comment if everything's clean, making sure not to spam"""
@@ -305,7 +507,7 @@ class PullRequest:
         }
         url = f"{self.base_url}/reviews"
 
-        post_review_response = requests.post(url, json=review, headers=headers)
+        post_review_response = self.session.post(url, json=review, headers=headers)
         print(post_review_response.text)
         try:
             post_review_response.raise_for_status()
@@ -332,7 +534,7 @@ class PullRequest:
         }
         url = f"{self.api_url}/repos/{self.repo_name}/check-runs"
 
-        response = requests.post(url, json=review, headers=headers)
+        response = self.session.post(url, json=review, headers=headers)
         response.raise_for_status()
 
 
@@ -346,22 +548,25 @@ def message_group(title: str):
 
 
 def make_file_line_lookup(diff):
-    """Get a lookup table for each file in diff, to convert between source
-    line number to line number in the diff
+    """Get a lookup table for the diff, to convert between (file, source
+    line number) and line number in the diff
 
     """
     lookup = {}
     for file in diff:
+        if len(file) == 0:
+            continue
         filename = file.target_file[2:]
-        lookup[filename] = {}
+        # GitHub expects "position" to count from the file's first hunk
+        # header, wherever the file happens to sit in the whole diff
+        first_hunk_header = file[0][0].diff_line_no - 1
         for hunk in file:
             for line in hunk:
-                if line.diff_line_no is None:
+                if line.diff_line_no is None or line.is_removed:
                     continue
-                if not line.is_removed:
-                    lookup[filename][line.target_line_no] = (
-                        line.diff_line_no - DIFF_HEADER_LINE_LENGTH
-                    )
+                lookup[(filename, line.target_line_no)] = (
+                    line.diff_line_no - first_hunk_header
+                )
     return lookup
 
 
@@ -437,10 +642,13 @@ def find_line_number_from_offset(offset_lookup, filename, offset):
         # Let's make sure we've the file offsets for this other file
         offset_lookup.update(make_file_offset_lookup([name]))
 
-    for line_num, line_offset in enumerate(offset_lookup[name]):
-        if line_offset > offset:
-            return line_num - 1
-    return -1
+    # The offsets are a cumulative sum, so they're already sorted and
+    # we can bisect instead of scanning every line in Python
+    line_offsets = offset_lookup[name]
+    index = bisect.bisect_right(line_offsets, offset)
+    if index == len(line_offsets):
+        return -1
+    return index - 1
 
 
 def read_one_line(filename, line_offset):
@@ -544,9 +752,10 @@ def replace_one_line(replacement_set, line_num, offset_lookup):
     for (_, start), (end, _) in zip(insert_offsets[:-1], insert_offsets[1:]):
         fragments.append(source_line[start:end])
 
-    new_line = ""
-    for fragment, replacement in zip(fragments, replacement_set):
-        new_line += fragment + replacement["ReplacementText"]
+    new_line = "".join(
+        fragment + replacement["ReplacementText"]
+        for fragment, replacement in zip(fragments, replacement_set)
+    )
 
     return source_line, new_line + fragments[-1]
 
@@ -569,8 +778,9 @@ def format_diff_line(diagnostic, offset_lookup, source_line, line_offset, line_n
 
     end_line = line_num
 
-    # We're going to be appending to this
-    code_blocks = ""
+    # We're going to be appending to this; joined up at the end to
+    # avoid quadratic string concatenation
+    code_blocks = []
 
     replacement_sets = collate_replacement_sets(diagnostic, offset_lookup)
 
@@ -586,11 +796,13 @@ def format_diff_line(diagnostic, offset_lookup, source_line, line_offset, line_n
         # format the replacement as a suggestion. Otherwise,
         # format it as a diff
         if replacement_line_num == line_num:
-            code_blocks += f"""
+            code_blocks.append(
+                f"""
 ```suggestion
 {new_line}
 ```
 """
+            )
             end_line = replacement_set[-1]["EndLineNumber"]
         else:
             # Prepend each line in the replacement line with "+ "
@@ -602,19 +814,22 @@ def format_diff_line(diagnostic, offset_lookup, source_line, line_offset, line_n
             old_line = whitespace.join([f"- {line}" for line in old_line.splitlines()])
 
             rel_path = try_relative(replacement_set[0]["FilePath"])
-            code_blocks += textwrap.dedent(
-                f"""\
-
-                {rel_path}:{replacement_line_num}:
-                ```diff
-                {old_line}
-                {new_line}
-                ```
-                """
+            code_blocks.append(
+                textwrap.dedent(
+                    f"""\
+
+                    {rel_path}:{replacement_line_num}:
+                    ```diff
+                    {old_line}
+                    {new_line}
+                    ```
+                    """
+                )
             )
-    return code_blocks, end_line
+    return "".join(code_blocks), end_line
 
 
+@functools.lru_cache(maxsize=None)
 def try_relative(path) -> pathlib.Path:
     """Try making `path` relative to current directory, otherwise make it an absolute path"""
     try:
@@ -638,23 +853,36 @@ def fix_absolute_paths(build_compile_commands, base_dir):
     print(f"Found '{build_compile_commands}', updating absolute paths")
     # We might need to change some absolute paths if we're inside
     # a docker container
-    with open(build_compile_commands, "r") as f:
-        compile_commands = json.load(f)
+    with open(build_compile_commands, "rb") as f:
+        compile_commands = orjson.loads(f.read()) if orjson else json.load(f)
 
     print(f"Replacing '{basedir}' with '{newbasedir}'", flush=True)
 
-    modified_compile_commands = json.dumps(compile_commands).replace(
-        str(basedir), str(newbasedir)
-    )
-
-    with open(build_compile_commands, "w") as f:
-        f.write(modified_compile_commands)
+    # Only the path-carrying fields can contain the old base directory,
+    # so rewrite those per entry rather than serialising the whole
+    # database to one big string and scanning it
+    old_base, new_base = str(basedir), str(newbasedir)
+    for entry in compile_commands:
+        for key in ("directory", "file", "output", "command"):
+            if key in entry:
+                entry[key] = entry[key].replace(old_base, new_base)
+        if "arguments" in entry:
+            entry["arguments"] = [
+                argument.replace(old_base, new_base) for argument in entry["arguments"]
+            ]
+
+    if orjson:
+        with open(build_compile_commands, "wb") as f:
+            f.write(orjson.dumps(compile_commands))
+    else:
+        with open(build_compile_commands, "w") as f:
+            json.dump(compile_commands, f)
 
 
 def format_notes(notes, offset_lookup):
     """Format an array of notes into a single string"""
 
-    code_blocks = ""
+    code_blocks = []
 
     for note in notes:
         filename = note["FilePath"]
@@ -675,12 +903,15 @@ def format_notes(notes, offset_lookup):
         path = try_relative(resolved_path)
         message = f"**{path}:{line_num}:** {note['Message']}"
         code = format_ordinary_line(source_line, line_offset)
-        code_blocks += f"{message}\n{code}"
+        code_blocks.append(f"{message}\n{code}")
 
     if notes:
-        code_blocks = f"<details>\n<summary>Additional context</summary>\n\n{code_blocks}\n</details>\n"
+        return (
+            "<details>\n<summary>Additional context</summary>\n\n"
+            f"{''.join(code_blocks)}\n</details>\n"
+        )
 
-    return code_blocks
+    return "".join(code_blocks)
 
 
 def make_comment_from_diagnostic(
@@ -745,25 +976,25 @@ def create_review_file(
         if diagnostic_message["FilePath"] == "":
             continue
 
+        file_path = get_diagnostic_file_path(diagnostic, build_dir)
+
         comment_body, end_line = make_comment_from_diagnostic(
             diagnostic["DiagnosticName"],
             diagnostic_message,
-            get_diagnostic_file_path(diagnostic, build_dir),
+            file_path,
             offset_lookup,
             notes=diagnostic.get("Notes", []),
         )
 
-        rel_path = try_relative(
-            get_diagnostic_file_path(diagnostic, build_dir)
-        ).as_posix()
+        rel_path = try_relative(file_path).as_posix()
         # diff lines are 1-indexed
         source_line = 1 + find_line_number_from_offset(
             offset_lookup,
-            get_diagnostic_file_path(diagnostic, build_dir),
+            file_path,
             diagnostic_message["FileOffset"],
         )
 
-        if rel_path not in diff_lookup or end_line not in diff_lookup[rel_path]:
+        if (rel_path, end_line) not in diff_lookup:
             print(
                 f"WARNING: Skipping comment for file '{rel_path}' not in PR changeset. Comment body is:\n{comment_body}"
             )
@@ -796,13 +1027,24 @@ def create_review_file(
 
 def filter_files(diff, include: List[str], exclude: List[str]) -> List:
     changed_files = [filename.target_file[2:] for filename in diff]
-    files = []
-    for pattern in include:
-        files.extend(fnmatch.filter(changed_files, pattern))
-        print(f"include: {pattern}, file list now: {files}")
-    for pattern in exclude:
-        files = [f for f in files if not fnmatch.fnmatch(f, pattern)]
-        print(f"exclude: {pattern}, file list now: {files}")
+
+    # Compile each pattern list into a single alternation up front, so
+    # every file is classified with one C-level regex match instead of
+    # a Python-level fnmatch call per pattern
+    include_re = re.compile("|".join(fnmatch.translate(pattern) for pattern in include))
+    exclude_re = (
+        re.compile("|".join(fnmatch.translate(pattern) for pattern in exclude))
+        if exclude
+        else None
+    )
+
+    files = [
+        filename
+        for filename in changed_files
+        if include_re.match(filename)
+        and not (exclude_re and exclude_re.match(filename))
+    ]
+    print(f"include: {include}, exclude: {exclude}, file list: {files}")
 
     return files
 
@@ -906,7 +1148,7 @@ def download_artifacts(pull: PullRequest, workflow_id: int):
         )
         return None, None
 
-    r = requests.get(artifact.archive_download_url, headers=pull.headers("json"))
+    r = pull.session.get(artifact.archive_download_url, headers=pull.headers("json"))
     if not r.ok:
         print(
             f"WARNING: Couldn't automatically download artifacts for workflow '{workflow_id}', response was: {r}: {r.reason}"
@@ -1022,13 +1264,18 @@ def get_line_ranges(diff, files):
                 if line.is_added:
                     added_lines.append(line.target_line_no)
 
-        for _, group in itertools.groupby(
-            enumerate(added_lines), lambda ix: ix[0] - ix[1]
-        ):
-            groups = list(map(itemgetter(1), group))
-            lines_by_file.setdefault(filename.target_file[2:], []).append(
-                [groups[0], groups[-1]]
-            )
+        if not added_lines:
+            continue
+
+        # Group consecutive line numbers into [start, end] ranges in a
+        # single pass
+        ranges = [[added_lines[0], added_lines[0]]]
+        for line_no in added_lines[1:]:
+            if line_no == ranges[-1][1] + 1:
+                ranges[-1][1] = line_no
+            else:
+                ranges.append([line_no, line_no])
+        lines_by_file[filename.target_file[2:]] = ranges
 
     line_filter_json = []
     for name, lines in lines_by_file.items():
@@ -1049,19 +1296,20 @@ def cull_comments(pull_request: PullRequest, review, max_comments):
 
     """
 
-    comments = pull_request.get_pr_comments()
-
-    for comment in comments:
-        review["comments"] = list(
-            filter(
-                lambda review_comment: not (
-                    review_comment["path"] == comment["path"]
-                    and review_comment["line"] == comment["line"]
-                    and review_comment["body"] == comment["body"]
-                ),
-                review["comments"],
-            )
-        )
+    try:
+        existing_comments = pull_request.get_review_comment_fingerprints()
+    except Exception as e:
+        print(f"WARNING: GraphQL comment query failed, falling back to REST: {e}")
+        existing_comments = {
+            (comment["path"], comment.get("line"), comment["body"])
+            for comment in pull_request.get_pr_comments()
+        }
+
+    review["comments"] = [
+        comment
+        for comment in review["comments"]
+        if (comment["path"], comment["line"], comment["body"]) not in existing_comments
+    ]
 
     if len(review["comments"]) > max_comments:
         review["body"] += (
@@ -1105,7 +1353,9 @@ def post_review(
     dry_run: bool,
 ) -> int:
     print(
-        "Created the following review:\n", pprint.pformat(review, width=130), flush=True
+        "Created the following review:\n",
+        json.dumps(review, indent=2, default=str),
+        flush=True,
     )
 
     if not review or review["comments"] == []:
@@ -1126,10 +1376,14 @@ def post_review(
         return total_comments
 
     if dry_run:
-        pprint.pprint(review, width=130)
+        print(json.dumps(review, indent=2, default=str))
         return total_comments
 
-    print("Posting the review:\n", pprint.pformat(trimmed_review), flush=True)
+    print(
+        "Posting the review:\n",
+        json.dumps(trimmed_review, indent=2, default=str),
+        flush=True,
+    )
     pull_request.post_review(trimmed_review)
 
     return total_comments
@@ -6,8 +6,8 @@
 # See LICENSE for more information
 
 import argparse
+import json
 import pathlib
-import pprint
 
 from clang_tidy_review import (
     PullRequest,
@@ -86,7 +86,7 @@ def main() -> int:
 
     print(
         "clang-tidy-review generated the following review",
-        pprint.pformat(review, width=130),
+        json.dumps(review, indent=2, default=str),
         flush=True,
     )
 
@@ -248,7 +248,9 @@ def test_load_clang_tidy_warnings(monkeypatch):
 def test_file_line_lookup():
     line_lookup = ctr.make_file_line_lookup(TEST_DIFF)
 
-    assert line_lookup == {"src/hello.cxx": dict(zip(range(2, 20), range(1, 19)))}
+    assert line_lookup == {
+        ("src/hello.cxx", line): line - 1 for line in range(2, 20)
+    }
 
 
 def test_file_offset_lookup():